@@ -9,8 +9,9 @@ queries = {
     "datasetKey": ["7a3679ef-5582-4aaa-81f0-8c2545cafc81", "50c9509d-22c7-4a22-a47d-8c48425ef4a7"],
 }
 
-data_generator = gbif_dl.api.generate_urls(queries=queries, label="speciesKey", nb_samples=1000)
-gbif_dl.export.to_csv(data_generator, "urls.csv")
+if __name__ == "__main__":
+    data_generator = gbif_dl.api.generate_urls(queries=queries, label="speciesKey", nb_samples=1000)
+    gbif_dl.export.to_csv(data_generator, "urls.csv")
 
 # gbif_dl.download(data_generator, root="download_test")
 
@@ -31,4 +32,4 @@ gbif_dl.export.to_csv(data_generator, "urls.csv")
 # data_generator = gbif_dl.dwca.generate_urls(
 #     "10.15468/dl.vnm42s", dwca_root_path="dwcas", label=None
 # )
-# gbif_dl.io.download(data_generator)
\ No newline at end of file
+# gbif_dl.io.download(data_generator)
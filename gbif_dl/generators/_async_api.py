@@ -0,0 +1,87 @@
+"""
+Asynchronous helpers to query the GBIF occurrence search API concurrently.
+"""
+
+import asyncio
+from typing import Dict, List, Tuple
+
+import aiohttp
+
+try:
+    # orjson parses the large search responses considerably faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+GBIF_SEARCH_URL = "https://api.gbif.org/v1/occurrence/search"
+
+
+def _to_api_params(params: Dict) -> List[Tuple[str, str]]:
+    """Converts pygbif style search arguments into url query parameters
+
+    Lists are expanded into repeated parameters, booleans are lowercased
+    and `None` values are dropped, the same way pygbif builds its requests.
+    """
+    api_params = []
+    for key, values in params.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = str(value).lower()
+            api_params.append((key, str(value)))
+    return api_params
+
+
+async def _fetch_page(
+    session: aiohttp.ClientSession, params: List[Tuple[str, str]], offset: int, limit: int
+) -> Dict:
+    """Fetches a single page of search results"""
+    page_params = params + [("offset", str(offset)), ("limit", str(limit))]
+    async with session.get(GBIF_SEARCH_URL, params=page_params) as res:
+        res.raise_for_status()
+        return json_loads(await res.read())
+
+
+async def _fetch_pages(
+    params: Dict, offsets: List[int], page_limit: int, concurrency: int = 16
+) -> List[Dict]:
+    """Concurrently fetches the search pages starting at `offsets`
+
+    Args:
+        params (Dict): pygbif style search arguments
+        offsets (List[int]): page offsets to be fetched
+        page_limit (int): number of records per page
+        concurrency (int, optional): Maximum number of concurrent requests. Defaults to 16.
+
+    Returns:
+        List[Dict]: api responses in the order of `offsets`
+    """
+    api_params = _to_api_params(params)
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency), trust_env=True
+    ) as session:
+        return await asyncio.gather(
+            *[_fetch_page(session, api_params, offset, page_limit) for offset in offsets]
+        )
+
+
+async def _count_many(params_list: List[Dict], concurrency: int = 16) -> List[int]:
+    """Concurrently counts the number of search results of several queries
+
+    Args:
+        params_list (List[Dict]): pygbif style search arguments, one per query
+        concurrency (int, optional): Maximum number of concurrent requests. Defaults to 16.
+
+    Returns:
+        List[int]: number of results in the order of `params_list`
+    """
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency), trust_env=True
+    ) as session:
+        pages = await asyncio.gather(
+            *[_fetch_page(session, _to_api_params(params), 0, 0) for params in params_list]
+        )
+    return [page["count"] for page in pages]
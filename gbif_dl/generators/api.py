@@ -3,20 +3,203 @@ This module creates the interface to the GBIF API. By providing queries to the a
 this module to obtain lists of urls of media data to be downloaded using the [io](gbif_dl.io) module.
 """
 
+import asyncio
+import aiohttp
 import pygbif
+import requests
+import requests_cache
 import itertools as it
 import random
 import pescador
-import hashlib
 import logging
-import numpy as np
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from ..stores import MediaData
-
-from typing import Dict, Optional, Union, List
+from ..utils import run_async, basename_hasher
+from ._async_api import (
+    GBIF_SEARCH_URL,
+    _fetch_page,
+    _fetch_pages,
+    _count_many,
+    _to_api_params,
+    json_loads,
+)
+
+from typing import AsyncGenerator, Callable, Dict, Optional, Union, List
 
 log = logging.getLogger(__name__)
 
+_randrange = random.randrange
+
+# keep-alive session shared by all page requests, so consecutive pages
+# reuse the same TCP and TLS connection instead of one per page
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# maximum number of url hashes kept in memory by the generator
+HASH_CACHE_SIZE = 65536
+
+# cached number of occurrences per query
+_count_cache = {}
+
+# GBIF search api does not allow paging beyond this offset
+MAX_SEARCH_OFFSET = 100000
+
+# persistent location of the pygbif request cache, so that repeated runs reuse it
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "gbif-dl"
+)
+
+
+def _enable_request_cache(cache_requests: bool, expire_after: int):
+    """Enables or disables the request cache used by pygbif
+
+    The cache is kept in `CACHE_DIR` instead of a temporary file, so that warm runs
+    do not request the same pages again. `Cache-Control` headers of the api are honored.
+    """
+    if not cache_requests:
+        requests_cache.uninstall_cache()
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    requests_cache.install_cache(
+        cache_name=os.path.join(CACHE_DIR, "api"),
+        backend="sqlite",
+        expire_after=expire_after,
+        cache_control=True,
+    )
+    requests_cache.remove_expired_responses()
+
+
+def _search_page(params: Dict, offset: int, limit: int) -> Dict:
+    """Fetches a single page of search results without going through pygbif
+
+    The response body is parsed with orjson when it is installed.
+    """
+    page_params = _to_api_params(params) + [("offset", str(offset)), ("limit", str(limit))]
+    res = _session.get(GBIF_SEARCH_URL, params=page_params, timeout=30)
+    res.raise_for_status()
+    return json_loads(res.content)
+
+
+def _search_pages(page_limit: int, mediatype: str, cache_requests: bool, *args, **kwargs):
+    """Yields search result pages one after another
+
+    Pages are fetched using pygbif only when its request cache is enabled.
+    The next page is requested in a background thread while the current
+    page is being processed, so that parsing and hashing overlap with the request.
+    """
+    params = dict(kwargs, mediatype=mediatype)
+
+    def fetch(offset: int) -> Dict:
+        if cache_requests or args:
+            return pygbif.occurrences.search(
+                mediatype=mediatype, offset=offset, limit=page_limit, *args, **kwargs
+            )
+        return _search_page(params, offset, page_limit)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch, 0)
+        while future is not None:
+            resp = future.result()
+            if resp["endOfRecords"]:
+                future = None
+            else:
+                future = executor.submit(fetch, resp["offset"] + page_limit)
+            yield resp
+
+
+def _search_pages_concurrent(page_limit: int, mediatype: str, page_concurrency: int, **kwargs):
+    """Yields search result pages, fetching `page_concurrency` pages at once
+
+    Page offsets are independent once the total number of results is known,
+    so pages are requested concurrently in windows of `page_concurrency`.
+    """
+    total = min(gbif_count(mediatype=mediatype, **kwargs), MAX_SEARCH_OFFSET)
+    offsets = list(range(0, total, page_limit))
+    params = dict(kwargs, mediatype=mediatype)
+    for i in range(0, len(offsets), page_concurrency):
+        window = offsets[i : i + page_concurrency]
+        yield from run_async(_fetch_pages, params, window, page_limit, concurrency=page_concurrency)
+
+
+def _media_parser(
+    label: Optional[str],
+    subset: Optional[str],
+    license_info: bool,
+    one_media_per_occurrence: bool,
+    basename_format: str,
+) -> Callable[[Dict], List[MediaData]]:
+    """Returns a function that extracts the media data from a search result page
+
+    The returned function keeps its url hash memo across pages, so the same parser
+    should be used for all pages of a query.
+    """
+    # the same media can be listed by several occurrences
+    hash_cache = {}
+    hash_url = basename_hasher(basename_format)
+    # bind hot callables to locals to skip global and attribute lookups per record
+    intern = sys.intern
+    randrange = _randrange
+    dget = dict.get
+
+    # specialize the item builder once instead of branching on license_info per record
+    if license_info:
+
+        def build(url: str, basename: str, output_label, media: Dict) -> MediaData:
+            return {
+                "url": url,
+                "basename": basename,
+                "label": output_label,
+                "subset": subset,
+                "publisher": dget(media, "publisher"),
+                "license": dget(media, "license"),
+                "rightsHolder": dget(media, "rightsHolder", dget(media, "creator")),
+            }
+
+    else:
+
+        def build(url: str, basename: str, output_label, media: Dict) -> MediaData:
+            return {"url": url, "basename": basename, "label": output_label, "subset": subset}
+
+    def parse_page(resp: Dict) -> List[MediaData]:
+        page = []
+        for metadata in resp.get("results", []):
+            # check if media key is present, skip the label work otherwise
+            medias = dget(metadata, "media")
+            if not medias:
+                continue
+            # store the valid label
+            if label:
+                raw_label = dget(metadata, label)
+                if raw_label is None or raw_label == "":
+                    continue
+                # labels repeat across records, interning shares a single string per label
+                output_label = intern(raw_label if type(raw_label) is str else str(raw_label))
+            else:
+                output_label = metadata
+            # multiple media can be attached
+            if one_media_per_occurrence:
+                # select one random url if one_media_per_occurrence
+                medias = (medias[randrange(len(medias))],)
+            for media in medias:
+                # check if the identifier (url) is present
+                url = dget(media, "identifier")
+                if url:
+                    # hash the url, which later becomes the datatype
+                    hashed_url = dget(hash_cache, url)
+                    if hashed_url is None:
+                        if len(hash_cache) >= HASH_CACHE_SIZE:
+                            hash_cache.clear()
+                        hashed_url = hash_url(url)
+                        hash_cache[url] = hashed_url
+
+                    page.append(build(url, hashed_url, output_label, media))
+        return page
+
+    return parse_page
+
 
 def gbif_query_generator(
     page_limit: int = 300,
@@ -26,6 +209,9 @@ def gbif_query_generator(
     label: Optional[str] = None,
     subset: Optional[str] = None,
     *args,
+    page_concurrency: Optional[int] = None,
+    basename_format: str = "sha1_hex",
+    cache_requests: bool = False,
     **kwargs,
 ) -> MediaData:
     """Performs media queries GBIF yielding url and label
@@ -37,76 +223,190 @@ def gbif_query_generator(
         one_media_per_occurrence (bool, optional): Only pick one image per occurrence. Default to True.
         label (str, optional): Output label name. Defaults to `None`.
         subset (str, optional): Subset name. Defaults to `None`.
+        page_concurrency (int, optional): Number of result pages fetched concurrently.
+            Ignored when positional `args` are given or `cache_requests` is enabled, these are
+            only handled by pygbif, which fetches pages one after another.
+            Defaults to `None` which fetches pages one after another.
+        basename_format (str, optional): How basenames are derived from urls,
+            see `gbif_dl.utils.basename_hasher`. Defaults to `sha1_hex`.
+        cache_requests (bool, optional): Fetch pages through pygbif so that its request cache,
+            enabled by `generate_urls`, is used. Defaults to False.
 
     Yields:
         MediaData
     """
-    offset = 0
+    parse_page = _media_parser(
+        label, subset, license_info, one_media_per_occurrence, basename_format
+    )
 
-    while True:
-        resp = pygbif.occurrences.search(
-            mediatype=mediatype, offset=offset, limit=page_limit, *args, **kwargs
-        )
+    if page_concurrency and not args and not cache_requests:
+        pages = _search_pages_concurrent(page_limit, mediatype, page_concurrency, **kwargs)
+    else:
+        pages = _search_pages(page_limit, mediatype, cache_requests, *args, **kwargs)
 
-        # Iterate over request pages. Can possibly also done async
-        for metadata in resp.get("results", []):
-            # check if media key is present
-            medias = metadata.get("media", None)
-            # store the valid label
-            if label:
-                output_label = str(metadata.get(label, None))
-                if output_label is None or not output_label:
-                    continue
-            else:
-                output_label = metadata
-            if medias:
-                # multiple media can be attached
-                if one_media_per_occurrence:
-                    # select one random url if one_media_per_occurrence
-                    medias = [random.choice(medias)]
-                for media in medias:
-                    # check if the identifier (url) is present
-                    url = media.get("identifier", None)
-                    if url:
-                        # hash the url, which later becomes the datatype
-                        hashed_url = hashlib.sha1(url.encode("utf-8")).hexdigest()
-
-                        media_data = {
-                            "url": url,
-                            "basename": hashed_url,
-                            "label": output_label,
-                            "subset": subset,
-                        }
-                        if license_info:
-                            media_data["publisher"] = media.get("publisher", None)
-                            media_data["license"] = media.get("license", None)
-                            media_data["rightsHolder"] = media.get(
-                                "rightsHolder", media.get("creator", None)
-                            )
-                        yield media_data
-
-        if resp["endOfRecords"]:
-            break
-        else:
-            offset = resp["offset"] + page_limit
+    for resp in pages:
+        yield from parse_page(resp)
+
+
+async def gbif_query_generator_async(
+    page_limit: int = 300,
+    mediatype: str = "StillImage",
+    license_info: bool = True,
+    one_media_per_occurrence: bool = True,
+    label: Optional[str] = None,
+    subset: Optional[str] = None,
+    basename_format: str = "sha1_hex",
+    **kwargs,
+) -> AsyncGenerator[MediaData, None]:
+    """Performs media queries GBIF yielding url and label from an async generator
+
+    Same as `gbif_query_generator` but pages are fetched with aiohttp, so that
+    the generator can be passed to the `gbif_dl.stores.dl_async` downloader
+    and page requests overlap with media downloads instead of blocking them.
+    The next page is requested while the records of the current page are yielded.
+
+    Args:
+        page_limit (int, optional): GBIF api uses paging which can be modified. Defaults to 300.
+        mediatype (str, optional): Sets GBIF mediatype. Defaults to 'StillImage'.
+        license_info (bool, optional): Retrieve images license information. Default to True.
+        one_media_per_occurrence (bool, optional): Only pick one image per occurrence. Default to True.
+        label (str, optional): Output label name. Defaults to `None`.
+        subset (str, optional): Subset name. Defaults to `None`.
+        basename_format (str, optional): How basenames are derived from urls,
+            see `gbif_dl.utils.basename_hasher`. Defaults to `sha1_hex`.
+
+    Yields:
+        MediaData
+    """
+    parse_page = _media_parser(
+        label, subset, license_info, one_media_per_occurrence, basename_format
+    )
+    params = _to_api_params(dict(kwargs, mediatype=mediatype))
+
+    async with aiohttp.ClientSession(trust_env=True) as session:
+        loop = asyncio.get_event_loop()
+        next_page = loop.create_task(_fetch_page(session, params, 0, page_limit))
+        try:
+            while next_page is not None:
+                resp = await next_page
+                # request the following page before the records of this one are consumed
+                if resp["endOfRecords"]:
+                    next_page = None
+                else:
+                    next_page = loop.create_task(
+                        _fetch_page(session, params, resp["offset"] + page_limit, page_limit)
+                    )
+                for media_data in parse_page(resp):
+                    yield media_data
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+
+def _freeze(value):
+    """Hashable and order independent representation of a query value"""
+    if isinstance(value, dict):
+        return tuple(sorted(((k, _freeze(v)) for k, v in value.items()), key=repr))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(sorted((_freeze(v) for v in value), key=repr))
+    return value
+
+
+def _count_key(mediatype: str, kwargs: Dict) -> tuple:
+    """Hashable representation of a count query, collection values are sorted and frozen"""
+    return (mediatype,) + tuple(sorted((k, _freeze(v)) for k, v in kwargs.items()))
 
 
 def gbif_count(mediatype: str = "StillImage", *args, **kwargs) -> str:
     """Count the number of occurrences from given query
 
+    Results of keyword queries are cached, so that repeated counts
+    of the same query do not result in additional api requests.
+
     Args:
         mediatype (str, optional): [description]. Defaults to 'StillImage'.
 
     Returns:
         str: [description]
     """
+    if args:
+        return pygbif.occurrences.search(limit=0, mediatype=mediatype, *args, **kwargs)["count"]
 
-    return pygbif.occurrences.search(limit=0, mediatype=mediatype, *args, **kwargs)["count"]
+    key = _count_key(mediatype, kwargs)
+    if key not in _count_cache:
+        _count_cache[key] = pygbif.occurrences.search(limit=0, mediatype=mediatype, **kwargs)[
+            "count"
+        ]
+    return _count_cache[key]
+
+
+def gbif_counts(
+    queries: List[Dict], mediatype: str = "StillImage", cache_requests: bool = False
+) -> List[int]:
+    """Count the number of occurrences of several queries concurrently
+
+    Args:
+        queries (List[Dict]): list of queries supported by the GBIF api
+        mediatype (str, optional): Sets GBIF mediatype. Defaults to 'StillImage'.
+        cache_requests (bool, optional): Count through pygbif one query after another,
+            so that the request cache enabled by `generate_urls` is used. Defaults to False.
+
+    Returns:
+        List[int]: number of occurrences per query
+    """
+    if cache_requests:
+        return [gbif_count(mediatype=mediatype, **query) for query in queries]
+
+    keys = [_count_key(mediatype, query) for query in queries]
+    missing = {key: query for key, query in zip(keys, queries) if key not in _count_cache}
+    if missing:
+        counts = run_async(
+            _count_many, [dict(query, mediatype=mediatype) for query in missing.values()]
+        )
+        _count_cache.update(zip(missing, counts))
+    return [_count_cache[key] for key in keys]
+
+
+def _index_subset_streams(subset_streams: Optional[Dict]):
+    """Index subset_streams by `(key, value)` pairs and wildcard keys
+
+    Args:
+        subset_streams (Dict, optional): mapping of subset names to query values
+
+    Returns:
+        Tuple[Dict, Dict]: subset names indexed by `(key, value)` and by wildcard key
+    """
+    lookup, wildcards = {}, {}
+    for x, y in (subset_streams or {}).items():
+        for key, result in y.items():
+            if result == "*":
+                # the first remainder subset of a key is used
+                wildcards.setdefault(key, x)
+            elif isinstance(result, (list, tuple, set, frozenset)):
+                for item in result:
+                    lookup[(key, item)] = x
+            elif result is not None:
+                lookup[(key, result)] = x
+    return lookup, wildcards
+
+
+def _resolve_subset(b: Dict, lookup: Dict, wildcards: Dict) -> Optional[str]:
+    """Returns the subset of stream `b`, explicit values taking precedence over wildcards"""
+    subset = None
+    for key, value in b.items():
+        subset = lookup.get((key, value), subset)
+    if subset is None:
+        for key in b:
+            if key in wildcards:
+                return wildcards[key]
+    return subset
 
 
 def _dproduct(dicts):
     """Returns the products of dicts"""
-    return (dict(zip(dicts, x)) for x in it.product(*dicts.values()))
+    # keys are extracted once instead of iterating the dict for every product
+    keys = tuple(dicts)
+    return (dict(zip(keys, x)) for x in it.product(*dicts.values()))
 
 
 def generate_urls(
@@ -122,6 +422,9 @@ def generate_urls(
     license_info: bool = True,
     one_media_per_occurrence: bool = True,
     verbose: bool = False,
+    page_concurrency: Optional[int] = None,
+    basename_format: str = "sha1_hex",
+    cache_expire_after: int = 86400,
 ):
     """Provides url generator from given query
 
@@ -147,25 +450,32 @@ def generate_urls(
             "test": { "speciesKey": "*" }}` will move species of 5352251 and 3190653
             into `train` whereas all other species will go into test.
         weighted_streams (int): Calculates sampling weights for all streams and applies them during
-            sampling. To be combined with nb_samples not `None`.
-            Defaults to `False`.
-        cache_requests (bool, optional): Enable GBIF API cache.
+            sampling. To be combined with nb_samples not `None`. When none of the streams has
+            any occurrence, nothing is yielded. Defaults to `False`.
+        cache_requests (bool, optional): Enable GBIF API cache, stored in `CACHE_DIR`.
             Can significantly improve API requests. Defaults to False.
         mediatype (str): supported GBIF media type. Can be `StillImage`, `MovingImage`, `Sound`.
             Defaults to `StillImage`.
         license_info (bool): retrieve images license information. Default to True.
         one_media_per_occurrence (bool): only retrieve one media in multiple media occurrences. Default to True,
-
+        page_concurrency (int, optional): Fetch this many result pages concurrently per stream.
+            Ignored when `cache_requests` is enabled since the cache is handled by pygbif.
+            Defaults to `None` which fetches one page after another.
+        basename_format (str): How basenames are derived from urls,
+            see `gbif_dl.utils.basename_hasher`. Defaults to `sha1_hex`.
+        cache_expire_after (int, optional): Number of seconds cached API responses
+            are reused. Defaults to one day.
 
     Returns:
         Iterable: generate-like object, that yields dictionaries
     """
     streams = []
     # set pygbif api caching
-    pygbif.caching(cache_requests)
+    _enable_request_cache(cache_requests, cache_expire_after)
+    if cache_requests:
+        page_concurrency = None
 
-    # copy queries since we delete keys from the dict
-    q = queries.copy()
+    q = queries
 
     # if weighted_streams and nb_samples_per_stream is not None:
     #     raise RuntimeError("weights can only be applied when the number of samples are limited.")
@@ -177,31 +487,24 @@ def generate_urls(
         if isinstance(split_streams_by, str):
             split_streams_by = [split_streams_by]
 
-        # remove balance_by from query and move to balance_queries
+        # move balance_by from query to balance_queries without mutating queries
         for key in split_streams_by:
-            balance_queries[key] = q.pop(key)
+            balance_queries[key] = queries[key]
+        q = {k: v for k, v in queries.items() if k not in balance_queries}
+
+        # resolve subsets from a precomputed index instead of scanning subset_streams per stream
+        subset_index = _index_subset_streams(subset_streams)
+
+        # materialize the stream product and merge each stream query once,
+        # both are shared by the streams and the counts
+        bs = tuple(_dproduct(balance_queries))
+        merged = [{**q, **b} for b in bs]
 
         # for each b in balance_queries, create a separate stream
         # later we control the sampling processs of these streams to balance them
-        for b in _dproduct(balance_queries):
-            subset = None
+        for b, m in zip(bs, merged):
             # for each stream we wrap into pescador Streamers for additional features
-            for key, value in b.items():
-                if subset_streams is not None:
-                    for x, y in subset_streams.items():
-                        result = y.get(key)
-                        if result is not None:
-                            if isinstance(result, list):
-                                for item in result:
-                                    if value == item:
-                                        subset = x
-                            else:
-                                if value == result:
-                                    subset = x
-
-                            # assign remainder class
-                            if result == "*" and subset is None:
-                                subset = x
+            subset = _resolve_subset(b, *subset_index)
 
             streams.append(
                 pescador.Streamer(
@@ -212,8 +515,10 @@ def generate_urls(
                         subset=subset,
                         license_info=license_info,
                         one_media_per_occurrence=one_media_per_occurrence,
-                        **q,
-                        **b,
+                        page_concurrency=page_concurrency,
+                        basename_format=basename_format,
+                        cache_requests=cache_requests,
+                        **m,
                     ),
                     # this makes sure that we only obtain a maximum number
                     # of samples per stream
@@ -221,34 +526,30 @@ def generate_urls(
                 )
             )
 
+        # count the available occurances of all streams concurrently
+        if verbose or nb_samples == -1 or weighted_streams:
+            counts = gbif_counts(merged, mediatype=mediatype, cache_requests=cache_requests)
+
         if verbose:
-            nb_queries = [
-                gbif_count(mediatype=mediatype, **q, **b) for b in _dproduct(balance_queries)
-            ]
-            print(sum(nb_queries))
+            print(sum(counts))
 
-        # count the available occurances for each stream and select the min.
         # We only yield the minimum of streams to balance
         if nb_samples == -1:
             # calculate the miniumum number of samples available per stream
-            nb_samples = min(
-                [gbif_count(mediatype=mediatype, **q, **b) for b in _dproduct(balance_queries)]
-            ) * len(streams)
+            nb_samples = min(counts) * len(bs)
 
         if weighted_streams:
-            weights = np.array(
-                [
-                    float(gbif_count(mediatype=mediatype, **q, **b))
-                    for b in _dproduct(balance_queries)
-                ]
-            )
-            weights /= np.max(weights)
+            max_count = max(counts)
+            if max_count == 0:
+                # no stream has any occurrence, there is nothing to weight or sample
+                return iter(())
+            weights = [c / float(max_count) for c in counts]
         else:
             weights = None
 
         mux = pescador.StochasticMux(
             streams,
-            n_active=len(streams),  # all streams are always active.
+            n_active=len(bs),  # all streams are always active.
             rate=None,  # all streams are balanced
             weights=weights,  # weight streams
             mode="exhaustive",  # if one stream fails it is not revived
@@ -262,11 +563,17 @@ def generate_urls(
 
         if verbose:
             print(nb_samples)
-        return pescador.Streamer(
-            gbif_query_generator,
+        # a single stream needs no muxing, hence no pescador streamer
+        gen = gbif_query_generator(
             label=label,
             mediatype=mediatype,
             license_info=license_info,
             one_media_per_occurrence=one_media_per_occurrence,
+            page_concurrency=page_concurrency,
+            basename_format=basename_format,
+            cache_requests=cache_requests,
             **q,
-        ).iterate(max_iter=nb_samples)
+        )
+        if nb_samples is None:
+            return gen
+        return it.islice(gen, max(nb_samples, 0))
@@ -8,13 +8,13 @@ import pygbif
 from pathlib import Path
 import random
 import requests
-import hashlib
 import re
 import tempfile
 from typing import Optional
 import os
 
 from ..stores import MediaData
+from ..utils import basename_hasher
 
 from dwca.read import DwCAReader
 from typing import Optional
@@ -22,6 +22,40 @@ from typing import Optional
 mmqualname = "http://purl.org/dc/terms/"
 gbifqualname = "http://rs.gbif.org/terms/1.0/"
 
+# private generator for picking one media per occurrence
+_rng = random.Random()
+
+# qualified term names looked up for every row
+_MM_ROWTYPE = gbifqualname + "Multimedia"
+_MM_TYPE_KEY = mmqualname + "type"
+_MM_IDENT_KEY = mmqualname + "identifier"
+_MM_PUBLISHER_KEY = mmqualname + "publisher"
+_MM_LICENSE_KEY = mmqualname + "license"
+_MM_RIGHTSHOLDER_KEY = mmqualname + "rightsHolder"
+_MM_CREATOR_KEY = mmqualname + "creator"
+
+# DOI patterns, combined into a single alternation compiled once at import
+_DOI_PATTERN = re.compile(
+    "|".join(
+        (
+            r"(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?![\"&\'])\S)+)",
+            r"(10.\d{4,9}/[-._;()/:A-Z0-9]+)",
+            r"(10.\d{4}/\d+-\d+X?(\d+)\d+<[\d\w]+:[\d\w]*>\d+.\d+.\w+;\d)",
+            r"(10.1021/\w\w\d+)",
+            r"(10.1207/[\w\d]+\&\d+_\d+)",
+        )
+    ),
+    re.IGNORECASE,
+)
+_GBIF_KEY_PATTERN = re.compile(r"^[0-9\-]*$")
+
+# keep-alive session, resolving several DOIs reuses the connection to datacite
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# resolved gbif keys per doi, a doi always points to the same download
+_doi_key_cache = {}
+
 
 def dwca_generator(
     dwca_path: str,
@@ -30,6 +64,7 @@ def dwca_generator(
     license_info: bool = True,
     one_media_per_occurrence: bool = True,
     delete: Optional[bool] = False,
+    basename_format: Optional[str] = None,
 ) -> MediaData:
     """Yields media urls from GBIF Darwin Core Archive
 
@@ -40,38 +75,53 @@ def dwca_generator(
         license_info (bool): retrieve images license information. Default to True.
         one_media_per_occurrence (bool): only retrieve one media in multiple media occurrences. Default to True,
         delete (bool, optional): Delete darwin core archive when finished.
+        basename_format (str, optional): How basenames are derived from urls,
+            see `gbif_dl.utils.basename_hasher`. Defaults to `None` which yields no
+            basename and leaves hashing to the downloader.
 
     Yields:
         Dict: Item dictionary
     """
+    hash_url = basename_hasher(basename_format) if basename_format is not None else None
+    label_key = gbifqualname + label if label is not None else None
     with DwCAReader(dwca_path) as dwca:
         for row in dwca:
-            img_extensions = []
-            for ext in row.extensions:
-                # multiple images are handled as multiple extensions
-                # therefore lets filter the images first and then
-                # yield a random one
-                if ext.rowtype == gbifqualname + "Multimedia":
-                    if ext.data[mmqualname + "type"] == mediatype:
-                        img_extensions.append(ext.data)
+            # skip occurrences without label, same as the api generator
+            if label is not None:
+                raw_label = row.data.get(label_key)
+                if raw_label is None or raw_label == "":
+                    continue
+                output_label = str(raw_label)
+            else:
+                output_label = row.data
 
+            # multiple images are handled as multiple extensions
+            # therefore lets filter the images first and then
+            # yield a random one
             if one_media_per_occurrence:
-                media = [random.choice(img_extensions)]
+                # reservoir sample a single media in one pass over the extensions
+                chosen, n = None, 0
+                for ext in row.extensions:
+                    if ext.rowtype == _MM_ROWTYPE and ext.data[_MM_TYPE_KEY] == mediatype:
+                        n += 1
+                        if _rng.randrange(n) == 0:
+                            chosen = ext.data
+                if chosen is None:
+                    # occurrence without media of the requested type
+                    continue
+                media = (chosen,)
             else:
-                media = img_extensions
+                media = [
+                    ext.data
+                    for ext in row.extensions
+                    if ext.rowtype == _MM_ROWTYPE and ext.data[_MM_TYPE_KEY] == mediatype
+                ]
 
             for selected_img in media:
-                url = selected_img.get(mmqualname + "identifier", None)
+                url = selected_img.get(_MM_IDENT_KEY, None)
                 if url:
                     # hash the url, which later becomes the datatype
-                    hashed_url = hashlib.sha1(url.encode("utf-8")).hexdigest()
-
-                    if label is not None:
-                        output_label = str(row.data.get(gbifqualname + label))
-                        if output_label is None or not output_label:
-                            continue
-                    else:
-                        output_label = row.data
+                    hashed_url = hash_url(url) if hash_url is not None else None
 
                     media_data = {
                         "url": url,
@@ -79,11 +129,11 @@ def dwca_generator(
                         "label": output_label,
                     }
                     if license_info:
-                        media_data["publisher"] = selected_img.get(mmqualname + "publisher", None)
-                        media_data["license"] = selected_img.get(mmqualname + "license", None)
+                        media_data["publisher"] = selected_img.get(_MM_PUBLISHER_KEY, None)
+                        media_data["license"] = selected_img.get(_MM_LICENSE_KEY, None)
                         media_data["rightsHolder"] = selected_img.get(
-                            mmqualname + "rightsHolder",
-                            selected_img.get(mmqualname + "creator", None),
+                            _MM_RIGHTSHOLDER_KEY,
+                            selected_img.get(_MM_CREATOR_KEY, None),
                         )
 
                     yield media_data
@@ -101,12 +151,16 @@ def doi_to_gbif_key(doi: str) -> str:
     Returns:
         str: gbif id
     """
-    r = requests.get("https://api.datacite.org/dois/" + doi)
+    if doi in _doi_key_cache:
+        return _doi_key_cache[doi]
+    r = _session.get("https://api.datacite.org/dois/" + doi, timeout=30)
     if r.status_code == requests.codes.ok:
         gbif_url = r.json().get("data").get("attributes").get("url")
         if gbif_url is not None:
             gbif_key = gbif_url.split("/")[-1]
-            if bool(re.match("^[0-9\-]*$", gbif_key)):
+            if _GBIF_KEY_PATTERN.match(gbif_key):
+                # failed lookups are not cached, they are retried on the next call
+                _doi_key_cache[doi] = gbif_key
                 return gbif_key
 
 
@@ -119,18 +173,7 @@ def is_doi(identifier: str) -> bool:
     Returns:
         bool: true if identifier is a valid DOI
     """
-    doi_patterns = [
-        r"(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?![\"&\'])\S)+)",
-        r"(10.\d{4,9}/[-._;()/:A-Z0-9]+)",
-        r"(10.\d{4}/\d+-\d+X?(\d+)\d+<[\d\w]+:[\d\w]*>\d+.\d+.\w+;\d)",
-        r"(10.1021/\w\w\d+)",
-        r"(10.1207/[\w\d]+\&\d+_\d+)",
-    ]
-    for pattern in doi_patterns:
-        match = bool(re.match(pattern, identifier))
-        if match:
-            return True
-    return False
+    return _DOI_PATTERN.match(identifier) is not None
 
 
 def generate_urls(
@@ -141,6 +184,7 @@ def generate_urls(
     license_info: bool = True,
     one_media_per_occurrence: bool = True,
     delete: Optional[bool] = False,
+    basename_format: Optional[str] = None,
 ):
     """Generate GBIF items from DOI or GBIF download key
 
@@ -157,11 +201,14 @@ def generate_urls(
         one_media_per_occurrence (bool): only retrieve one media in multiple media occurrences. Default to True,
 
         delete (bool, optional): Delete darwin core archive when finished.
+        basename_format (str, optional): How basenames are derived from urls,
+            see `gbif_dl.utils.basename_hasher`. Defaults to `None` which leaves
+            hashing to the downloader.
 
     Returns:
         Iterable: item generator that yields files from generator
     """
-    if is_doi:
+    if is_doi(identifier):
         key = doi_to_gbif_key(identifier)
     else:
         key = identifier
@@ -185,4 +232,5 @@ def generate_urls(
         one_media_per_occurrence=one_media_per_occurrence,
         license_info=license_info,
         delete=delete,
+        basename_format=basename_format,
     )
@@ -11,10 +11,11 @@ Backport of the asyncio.runners module from Python 3.7.
 #   backwards compatible.
 # * Use private function `asyncio.events._get_running_loop` directly in
 #   Python 3.6
+# * `loop_factory` argument of `run`, as added in Python 3.12
 
 import asyncio
 import weakref
-from typing import Any, Awaitable, Coroutine, TypeVar, Union
+from typing import Any, Awaitable, Callable, Coroutine, Optional, TypeVar, Union
 
 
 try:
@@ -67,7 +68,12 @@ def _patch_loop(loop):
     return tasks
 
 
-def run(main: Union[Coroutine[Any, None, _T], Awaitable[_T]], *, debug: bool = False) -> _T:
+def run(
+    main: Union[Coroutine[Any, None, _T], Awaitable[_T]],
+    *,
+    debug: bool = False,
+    loop_factory: Optional[Callable[[], asyncio.AbstractEventLoop]] = None,
+) -> _T:
     """Run a coroutine.
     This function runs the passed coroutine, taking care of
     managing the asyncio event loop and finalizing asynchronous
@@ -75,6 +81,7 @@ def run(main: Union[Coroutine[Any, None, _T], Awaitable[_T]], *, debug: bool = F
     This function cannot be called when another asyncio event loop is
     running in the same thread.
     If debug is True, the event loop will be run in debug mode.
+    If loop_factory is given, it is used to create the event loop.
     This function always creates a new event loop and closes it at the end.
     It should be used as a main entry point for asyncio programs, and should
     ideally only be called once.
@@ -95,7 +102,7 @@ def run(main: Union[Coroutine[Any, None, _T], Awaitable[_T]], *, debug: bool = F
     if not asyncio.iscoroutine(main):
         raise ValueError("a coroutine was expected, got {!r}".format(main))
 
-    loop = asyncio.new_event_loop()
+    loop = loop_factory() if loop_factory is not None else asyncio.new_event_loop()
     tasks = _patch_loop(loop)
 
     try:
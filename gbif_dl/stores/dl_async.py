@@ -2,14 +2,22 @@
 Async based fast downloader.
 """
 import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import enum
+import functools
 import inspect
+import itertools
 from pathlib import Path
-from typing import AsyncGenerator, Callable, Generator, Union, Optional
+from typing import AsyncGenerator, Callable, Dict, Generator, List, Tuple, Union, Optional
 import sys
+import threading
 import json
-import hashlib
 import random
 import logging
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
 from tqdm.contrib.logging import logging_redirect_tqdm
 
 if sys.version_info >= (3, 8):
@@ -17,25 +25,315 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import TypedDict
 
-from collections.abc import Iterable
+from collections.abc import Iterable, Mapping, Sequence
 
 
 import filetype
-import aiofiles
 import aiohttp
-import aiostream
-from aiohttp_retry import RetryClient, ExponentialRetry
+from aiohttp_retry import RetryClient, JitterRetry
 from tqdm.asyncio import tqdm, tqdm_asyncio
-from ..utils import run_async
+from ..utils import run_async, basename_hasher
 from . import MediaData
 
+try:
+    # c-ares based lookups, aiohttp only uses aiodns when its resolver is passed explicitly
+    import aiodns  # noqa: F401
+
+    _Resolver = aiohttp.AsyncResolver
+except ImportError:
+    _Resolver = None
+
+
+# private generator for random subset assignment
+_rng = random.Random()
+
+# dedicated pool for disk writes, keeps file io off the event loop
+_WRITE_POOL = ThreadPoolExecutor(max_workers=16)
+
+
+# filetype only inspects the first 261 bytes of a file
+HEADER_SIZE = 261
+CHUNK_SIZE = 64 * 1024
+# received chunks are collected up to this size before they are handed to the write pool
+WRITE_SIZE = 1024 * 1024
+
+# dead hosts and stalled transfers fail early instead of after aiohttp's 5 minute
+# total timeout. There is no total limit, so large media files are not cut off.
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+
+# distinguishes the temporary files of concurrent downloads to the same path
+_part_ids = itertools.count()
+
+
+# signatures of the most common media formats, checked before falling back to filetype.
+# TIFF is left to filetype since raw camera formats share its signature.
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+
+def _guess_extension(header: bytes) -> Optional[str]:
+    """Guesses the file extension from the first bytes of a file"""
+    for signature, extension in _SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    kind = filetype.guess(header)
+    return kind.extension if kind is not None else None
+
+
+@functools.lru_cache(maxsize=256)
+def _extension_from_content_type(content_type: Optional[str]) -> Optional[str]:
+    """Guesses the file extension from a media Content-Type header
+
+    Only used when the first bytes are not recognized. Non-media types such as
+    html error pages are ignored so that they are not stored as media.
+    """
+    if not content_type:
+        return None
+    mime = content_type.partition(";")[0].strip().lower()
+    if not mime.startswith(("image/", "video/", "audio/")):
+        return None
+    extension = mimetypes.guess_extension(mime)
+    return extension[1:] if extension else None
+
+
+def _write_sidecar(sidecar: Optional[Tuple[str, str]]):
+    if sidecar is not None:
+        path, text = sidecar
+        with open(path, "w") as f:
+            f.write(text)
+
+
+def _open_part(path: str):
+    """Creates a hidden temporary file next to `path`, unique for every download
+
+    Returns:
+        Tuple: the file opened for writing and its path
+    """
+    head, tail = os.path.split(path)
+    while True:
+        tmp_path = os.path.join(head, ".%s.%d-%d.part" % (tail, os.getpid(), next(_part_ids)))
+        try:
+            return open(tmp_path, "xb"), tmp_path
+        except FileExistsError:
+            # left behind by an earlier process with the same pid
+            continue
+
+
+def _discard_part(f, tmp_path: str):
+    f.close()
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def _finish_file(
+    f,
+    tmp_path: Optional[str],
+    path: str,
+    tail: bytes,
+    sidecar: Optional[Tuple[str, str]] = None,
+    mtime: Optional[float] = None,
+):
+    if f is None:
+        f, tmp_path = _open_part(path)
+    try:
+        with f:
+            f.write(tail)
+        if mtime is not None:
+            os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, path)
+    except BaseException:
+        _discard_part(f, tmp_path)
+        raise
+    _write_sidecar(sidecar)
+
+
+def _write_blob(
+    path: str,
+    data: bytes,
+    sidecar: Optional[Tuple[str, str]] = None,
+    mtime: Optional[float] = None,
+):
+    _finish_file(None, None, path, data, sidecar, mtime)
+
+
+def _index_dir(path: str) -> Dict[str, str]:
+    """Creates `path` if needed and maps the basenames of the files it contains to file names
+
+    Media files take precedence over json sidecars of the same basename. During a run,
+    basenames that are still being downloaded map to `None`.
+    """
+    os.makedirs(path, exist_ok=True)
+    index = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            stem, ext = os.path.splitext(entry.name)
+            if ext != ".json" or stem not in index:
+                index[stem] = entry.name
+    return index
+
+
+def _modified_since_header(path: str) -> Dict[str, str]:
+    """Conditional request header that asks the server to only resend `path` if it changed"""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {}
+    return {"If-Modified-Since": formatdate(mtime, usegmt=True)}
+
+
+def _last_modified(res: aiohttp.ClientResponse) -> Optional[float]:
+    """Timestamp of the `Last-Modified` response header, stored as mtime of the written file
+
+    Files then carry the modification time of the server and not the time of the
+    download, so that later conditional requests compare server times only.
+    """
+    value = res.headers.get("Last-Modified")
+    if value is None:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+async def _read_header(res: aiohttp.ClientResponse) -> bytes:
+    try:
+        return await res.content.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        # files smaller than the header
+        return e.partial
+
+
+async def _stream_to_file(
+    res: aiohttp.ClientResponse,
+    header: bytes,
+    path: str,
+    sidecar: Optional[Tuple[str, str]] = None,
+    mtime: Optional[float] = None,
+):
+    """Writes the already consumed `header` and the rest of the body to `path`
+
+    The body is written to a hidden temporary file next to `path` which is only
+    renamed once the download is complete, so that interrupted downloads are
+    not mistaken for existing files. Every download gets its own temporary file,
+    concurrent downloads of the same file do not write into each other. The optional `sidecar` `(path, text)` is
+    written in the same executor job that finishes the file, which also sets
+    the optional modification time `mtime`.
+
+    Chunks are collected up to `WRITE_SIZE` before each write, so files smaller
+    than that cost a single executor job.
+    """
+    loop = asyncio.get_event_loop()
+    f, tmp_path = None, None
+    buf = bytearray(header)
+    try:
+        async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+            buf += chunk
+            if len(buf) >= WRITE_SIZE:
+                if f is None:
+                    f, tmp_path = await loop.run_in_executor(_WRITE_POOL, _open_part, path)
+                data, buf = buf, bytearray()
+                await loop.run_in_executor(_WRITE_POOL, f.write, data)
+    except BaseException:
+        if f is not None:
+            await loop.run_in_executor(_WRITE_POOL, _discard_part, f, tmp_path)
+        raise
+    await loop.run_in_executor(_WRITE_POOL, _finish_file, f, tmp_path, path, buf, sidecar, mtime)
+
+
+def _read_urls(path: Union[str, Path]) -> Generator[str, None, None]:
+    """Lazily yields the url of every line of a text file"""
+    with open(path) as f:
+        for line in f:
+            # ignore all string after first space
+            yield line.rstrip("\r\n").partition(" ")[0]
+
+
+async def _iterate(items: Iterable) -> AsyncGenerator:
+    """Wraps a sync iterable into an async generator"""
+    for item in items:
+        yield item
+
+
+async def _iterate_threaded(
+    items: Iterable, chunk_size: int = 256, max_chunks: int = 8
+) -> AsyncGenerator:
+    """Wraps a sync iterable into an async generator, consuming it in a background thread
+
+    Generators that request pages from the api would otherwise block the event loop
+    and with it all running downloads. Items are handed over in chunks of up to
+    `chunk_size`, partial chunks are handed over right away while the consumer waits.
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(max_chunks)
+    stop = threading.Event()
+
+    def put(chunk):
+        asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+
+    def produce():
+        chunk = []
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                chunk.append(item)
+                if len(chunk) >= chunk_size or queue.empty():
+                    put(chunk)
+                    chunk = []
+            if chunk:
+                put(chunk)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    # daemon thread, a producer blocked on an abandoned queue does not prevent exiting
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            for item in chunk:
+                yield item
+    finally:
+        stop.set()
+        # unblock a producer waiting for a free slot
+        while not queue.empty():
+            queue.get_nowait()
+
+
+class Outcome(enum.Enum):
+    """Result of downloading a single item, counted in the download statistics"""
+
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    SUCCESS = "success"
+
 
 class DownloadParams(TypedDict):
     root: str
     overwrite: bool
+    only_modified: bool
     is_valid_file: Optional[Callable[[bytes], bool]]
     proxy: Optional[str]
     random_subsets: Optional[dict]
+    subset_weights: Optional[Tuple[Tuple[str, ...], Tuple[float, ...]]]
+    hash_url: Callable[[str], str]
+    dir_index: Dict[str, asyncio.Future]
 
 
 async def download_single(
@@ -44,11 +342,12 @@ async def download_single(
     """Async function to download single url to disk
 
     Args:
-        item (Dict or str): item dict or url.
+        item (Mapping or str): item dict, or any other mapping, or url.
         session (RetryClient): aiohttp session.
         params (DownloadParams): Download parameter dict
     """
-    if isinstance(item, dict):
+    # any mapping is accepted as item, e.g. read-only views of shared items
+    if isinstance(item, Mapping):
         url = item.get("url")
         basename = item.get("basename")
         label = item.get("label")
@@ -57,103 +356,191 @@ async def download_single(
         url = item
         label, basename, subset = None, None, None
 
-    if subset is None and params["random_subsets"] is not None:
-        subset_choices = list(params["random_subsets"].keys())
-        p = list(params["random_subsets"].values())
-        subset = random.choices(subset_choices, weights=p, k=1)[0]
+    if subset is None and params["subset_weights"] is not None:
+        subset_choices, cum_weights = params["subset_weights"]
+        subset = _rng.choices(subset_choices, cum_weights=cum_weights, k=1)[0]
 
-    label_path = Path(params["root"])
+    # plain string paths, this runs for every item
+    label_path = params["root"]
 
     if subset is not None:
-        label_path /= Path(subset)
+        label_path = os.path.join(label_path, subset)
 
     # create subfolder when label is a single str
     if isinstance(label, str):
         # append label path
-        label_path /= Path(label)
-
-    label_path.mkdir(parents=True, exist_ok=True)
+        label_path = os.path.join(label_path, label)
 
     if basename is None:
         # hash the url
-        basename = hashlib.sha1(url.encode("utf-8")).hexdigest()
-
-    check_files_with_same_basename = label_path.glob(basename + "*")
-    if list(check_files_with_same_basename) and not params["overwrite"]:
-        # do not overwrite, skips based on base path
-        return False
-
-    async with session.get(url, proxy=params["proxy"]) as res:
-        content = await res.read()
-
-    # guess mimetype and suffix from content
-    kind = filetype.guess(content)
-    if kind is None:
-        return False
-    else:
-        suffix = "." + kind.extension
-        mime = kind.mime
-
-    # Check everything went well
-    if res.status != 200:
-        raise aiohttp.ClientResponseError
-
-    if params["is_valid_file"] is not None:
-        if not params["is_valid_file"](content):
-            print(f"File check failed")
+        basename = params["hash_url"](url)
+
+    loop = asyncio.get_event_loop()
+
+    # each folder is created and listed once per run, later lookups hit the index.
+    # Concurrent items of a new folder await the same pending scan.
+    index = params["dir_index"].get(label_path)
+    if index is None:
+        index = loop.run_in_executor(_WRITE_POOL, _index_dir, label_path)
+        params["dir_index"][label_path] = index
+    existing = await index
+
+    headers = {}
+    reserved = False
+    if basename in existing:
+        if not params["overwrite"]:
+            # do not overwrite, skips based on base path and downloads in progress
             return False
+        name = existing[basename]
+        if params["only_modified"] and name is not None and not name.endswith(".json"):
+            headers = _modified_since_header(os.path.join(label_path, name))
+    else:
+        # reserved until the download finishes, duplicate items are skipped meanwhile
+        existing[basename] = None
+        reserved = True
+
+    try:
+        async with session.get(url, proxy=params["proxy"], headers=headers) as res:
+            if res.status == 304:
+                # file on disk is still up to date
+                return False
+
+            # guess suffix from the first bytes only
+            header = await _read_header(res)
+            extension = _guess_extension(header)
+            if extension is None:
+                # fall back to the server provided type, no additional request needed
+                extension = _extension_from_content_type(res.headers.get("Content-Type"))
+            if extension is None:
+                return False
+            suffix = "." + extension
+
+            # Check everything went well
+            if res.status != 200:
+                raise aiohttp.ClientResponseError
+
+            file_base_path = os.path.join(label_path, basename)
+            file_path = file_base_path + suffix
+
+            mtime = _last_modified(res)
+            sidecar = None
+            if isinstance(label, Mapping):
+                sidecar = (file_base_path + ".json", json.dumps(dict(label)))
+
+            if params["is_valid_file"] is not None:
+                # the validity check needs the complete file in memory
+                content = header + await res.content.read()
+                if not params["is_valid_file"](content):
+                    return False
+                await loop.run_in_executor(
+                    _WRITE_POOL, _write_blob, file_path, content, sidecar, mtime
+                )
+            else:
+                await _stream_to_file(res, header, file_path, sidecar, mtime)
 
-    file_base_path = label_path / basename
-    file_path = file_base_path.with_suffix(suffix)
-    async with aiofiles.open(file_path, "+wb") as f:
-        await f.write(content)
-
-    if isinstance(label, dict):
-        json_path = (label_path / item["basename"]).with_suffix(".json")
-        async with aiofiles.open(json_path, mode="+w") as fp:
-            await fp.write(json.dumps(label))
+        existing[basename] = basename + suffix
+        reserved = False
+    finally:
+        if reserved and existing.get(basename) is None:
+            # nothing was written, a later duplicate may try again
+            existing.pop(basename, None)
 
     return True
 
 
-async def _download_queue(
-    queue: asyncio.Queue,
+async def _download_bounded(
+    sample: Union[MediaData, str],
     session: RetryClient,
-    stats: dict,
     params: DownloadParams,
-    progressbar: tqdm_asyncio = None,
+    slots: asyncio.Semaphore,
     logger: logging.Logger = None,
-):
-    """Consumes items from download queue
+) -> Outcome:
+    """Downloads a single item and releases its download slot when finished
 
     Args:
-        queue (asyncio.Queue): Queue of items
+        sample (Dict or str): item dict or url.
         session (RetryClient): RetryClient aiohttp session object
         params (DownloadParams): Download parameter dict
+        slots (asyncio.Semaphore): Semaphore acquired by the producer for this item
         logger (logging.Logger): Logger object
-    """
-    while True:
-        batch = await queue.get()
-        for sample in batch:
-            failed = False
-            try:
-                success = await download_single(sample, session, params)
-            except Exception as e:
-                with logging_redirect_tqdm(loggers=[logger]):
-                    logger.error(e.request_info.url, extra={"status": e.status})
-                    failed = True
-
-            if failed:
-                stats["failed"] += 1
-            elif not success:
-                stats["skipped"] += 1
-            else:
-                stats["success"] += 1
 
-            progressbar.set_postfix(stats=stats, refresh=True)
-            progressbar.update(1)
+    Returns:
+        Outcome: whether the item was downloaded, skipped or failed
+    """
+    try:
+        success = await download_single(sample, session, params)
+    except Exception as e:
+        if logger.isEnabledFor(logging.ERROR):
+            url = sample["url"] if isinstance(sample, Mapping) else sample
+            # errors raised before a response was received carry no status
+            status = getattr(e, "status", type(e).__name__)
+            logger.error(url, extra={"status": status})
+        return Outcome.FAILED
+    finally:
+        slots.release()
+
+    return Outcome.SUCCESS if success else Outcome.SKIPPED
+
+
+async def _schedule_downloads(
+    items: AsyncGenerator,
+    session: RetryClient,
+    stats: Counter,
+    params: DownloadParams,
+    nb_workers: int,
+    progressbar: tqdm_asyncio = None,
+    logger: logging.Logger = None,
+):
+    """Downloads all items, running at most `nb_workers` downloads at once
 
-        queue.task_done()
+    The outcome of every finished task is counted in `stats`.
+    """
+    loop = asyncio.get_event_loop()
+    # every item is its own task, at most `nb_workers` of them run at once.
+    # The slot is taken before the task is created so that the generator
+    # is not drained faster than items can be downloaded.
+    slots = asyncio.Semaphore(nb_workers)
+    pending = set()
+
+    def _finished(task: asyncio.Task):
+        pending.discard(task)
+        if task.cancelled():
+            # downloads are only cancelled when the whole run stops
+            return
+        stats[task.result().value] += 1
+        progressbar.update(1)
+
+    try:
+        async for sample in items:
+            await slots.acquire()
+            task = loop.create_task(
+                _download_bounded(
+                    sample,
+                    session,
+                    params=params,
+                    slots=slots,
+                    logger=logger,
+                )
+            )
+            pending.add(task)
+            task.add_done_callback(_finished)
+
+        if pending:
+            await asyncio.gather(*pending)
+    finally:
+        # a failing generator or a cancelled run must not leave downloads running
+        if pending:
+            tasks = list(pending)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _refresh_stats(progressbar: tqdm_asyncio, stats: Counter, interval: float = 0.5):
+    """Periodically shows the download statistics in the progressbar"""
+    while True:
+        progressbar.set_postfix(stats=dict(stats), refresh=False)
+        await asyncio.sleep(interval)
 
 
 async def _download_from_asyncgen(
@@ -163,7 +550,10 @@ async def _download_from_asyncgen(
     nb_workers: int = 64,
     batch_size: int = 16,
     retries: int = 1,
+    read_bufsize: int = 2**20,
     logger: logging.Logger = None,
+    session: Optional[aiohttp.ClientSession] = None,
+    tcp_connections_per_host: int = 0,
 ):
     """Asynchronous downloader that takes an interable and downloads it
 
@@ -171,50 +561,165 @@ async def _download_from_asyncgen(
         items (Union[Generator, AsyncGenerator]): (async/sync) generator that yiels a standardized dict of urls
         params (DownloadParams): Download parameter dict
         tcp_connections (int, optional): Maximum number of concurrent TCP connections. Defaults to 128.
-        nb_workers (int, optional): Maximum number of workers. Defaults to 64.
-        batch_size (int, optional): Maximum queue batch size. Defaults to 16.
+        nb_workers (int, optional): Maximum number of concurrent downloads. Defaults to 64.
+        batch_size (int, optional): Unused, items are scheduled one by one.
+            Kept for backwards compatibility.
         retries (int, optional): Maximum number of attempts. Defaults to 1.
+        read_bufsize (int, optional): Size of the response read buffer in bytes. Defaults to 1 MiB.
         logger (logging.Logger, optional): Logger object. Defaults to None.
+        session (aiohttp.ClientSession, optional): Existing session to download with. It is
+            left open, `tcp_connections` and `read_bufsize` do not apply. Defaults to None.
+        tcp_connections_per_host (int, optional): Maximum number of concurrent TCP connections
+            to the same host. Defaults to 0, which only applies `tcp_connections`.
     Raises:
         NotImplementedError: If generator turns out to be invalid.
     """
 
-    queue = asyncio.Queue(nb_workers)
     progressbar = tqdm(
         smoothing=0, unit=" Downloads", disable=logger.getEffectiveLevel() > logging.INFO
     )
-    stats = {"failed": 0, "skipped": 0, "success": 0}
-
-    retry_options = ExponentialRetry(attempts=retries)
-
-    async with RetryClient(
-        connector=aiohttp.TCPConnector(limit=tcp_connections),
-        raise_for_status=True,
-        retry_options=retry_options,
-        trust_env=True,
-    ) as session:
-
-        loop = asyncio.get_event_loop()
-        workers = [
-            loop.create_task(
-                _download_queue(
-                    queue, session, stats, params=params, progressbar=progressbar, logger=logger
+    stats = Counter({outcome.value: 0 for outcome in Outcome})
+
+    # server errors and rate limits are retried with jittered exponential backoff,
+    # so that many concurrent downloads do not retry in lockstep
+    retry_options = JitterRetry(
+        attempts=retries,
+        start_timeout=0.5,
+        max_timeout=30.0,
+        statuses={429},
+        random_interval_size=1.0,
+    )
+
+    # console log handlers are redirected through tqdm once for the whole run
+    # instead of for every failed item
+    with logging_redirect_tqdm(loggers=[logger]):
+        # stats are shown periodically instead of being formatted for every item
+        refresher = asyncio.get_event_loop().create_task(_refresh_stats(progressbar, stats))
+        try:
+            if session is not None:
+                client = RetryClient(
+                    client_session=session, raise_for_status=True, retry_options=retry_options
                 )
-            )
-            for _ in range(nb_workers)
-        ]
+                await _schedule_downloads(
+                    items, client, stats, params, nb_workers, progressbar, logger
+                )
+            else:
+                async with RetryClient(
+                    # media urls usually point to a handful of hosts, keep their addresses cached
+                    connector=aiohttp.TCPConnector(
+                        limit=tcp_connections,
+                        limit_per_host=tcp_connections_per_host,
+                        ttl_dns_cache=600,
+                        # idle connections survive generator stalls, e.g. while the next page loads
+                        keepalive_timeout=75,
+                        enable_cleanup_closed=True,
+                        resolver=_Resolver() if _Resolver is not None else None,
+                    ),
+                    raise_for_status=True,
+                    read_bufsize=read_bufsize,
+                    timeout=DOWNLOAD_TIMEOUT,
+                    retry_options=retry_options,
+                    trust_env=True,
+                ) as client:
+                    await _schedule_downloads(
+                        items, client, stats, params, nb_workers, progressbar, logger
+                    )
+        finally:
+            refresher.cancel()
+            await asyncio.gather(refresher, return_exceptions=True)
+            progressbar.set_postfix(stats=dict(stats))
+            progressbar.close()
+
+    return dict(stats)
+
+
+def _prepare_download(
+    items: Union[Generator, AsyncGenerator, Iterable, Path],
+    root: str,
+    loglevel: str,
+    error_log_path: Optional[Path],
+    overwrite: bool,
+    is_valid_file: Optional[Callable[[bytes], bool]],
+    proxy: Optional[str],
+    random_subsets: Optional[dict],
+    basename_format: str,
+    only_modified: bool = False,
+) -> Tuple[AsyncGenerator, DownloadParams, logging.Logger, List[logging.Handler]]:
+    """Converts the items into an async generator and sets up download parameters and logger
+
+    The returned log handlers are attached to the shared `error_urls` logger for this
+    run only and have to be released with `_release_handlers` when the run ends.
+    """
+    if isinstance(items, (Path, str)):
+        if Path(items).exists():
+            items = _read_urls(items)
+
+    # check if the generator is async
+    if not inspect.isasyncgen(items):
+        # if its not, apply hack to make it async
+        if isinstance(items, Sequence):
+            # in memory items are never blocking
+            items = _iterate(items)
+        elif inspect.isgenerator(items) or isinstance(items, Iterable):
+            items = _iterate_threaded(items)
+        else:
+            raise NotImplementedError("Provided iteratable could not be converted")
+
+    if random_subsets is not None:
+        p = random_subsets.values()
+        if sum(p) != 1.0:
+            raise RuntimeError("Make sure that weight probabilities add up to one")
+
+    logger = logging.getLogger("error_urls")
 
-        # get chunks from async generator and add to async queue
-        async with aiostream.stream.chunks(items, batch_size).stream() as chnk:
-            async for batch in chnk:
-                await queue.put(batch)
+    # set log format suitable for error logs and io
+    formatter = logging.Formatter("%(message)s %(status)s")
+    # set default log level to only receive errors
+    logger.setLevel(loglevel)
 
-        await queue.join()
+    handlers = []
+    if logger.getEffectiveLevel() <= logging.ERROR:
+        # write errors to std.out
+        sh = logging.StreamHandler(sys.stdout)
+        sh.setFormatter(formatter)
+        handlers.append(sh)
+        # in case an error path is set, also write errors to file
+        if isinstance(error_log_path, str):
+            fh = logging.FileHandler(error_log_path)
+            fh.setFormatter(formatter)
+            handlers.append(fh)
 
-    for w in workers:
-        w.cancel()
+    for handler in handlers:
+        logger.addHandler(handler)
 
-    return stats
+    logger.propagate = False
+
+    params = {
+        "root": os.fspath(root),
+        "overwrite": overwrite,
+        "only_modified": only_modified,
+        "is_valid_file": is_valid_file,
+        "proxy": proxy,
+        "random_subsets": random_subsets,
+        # subset names and cumulative weights, computed once for all items
+        "subset_weights": (
+            (tuple(random_subsets), tuple(itertools.accumulate(random_subsets.values())))
+            if random_subsets is not None
+            else None
+        ),
+        "dir_index": {},
+        # memoized, so that urls seen again (duplicates, retries, splits) are hashed once
+        "hash_url": functools.lru_cache(maxsize=65536)(basename_hasher(basename_format)),
+    }
+
+    return items, params, logger, handlers
+
+
+def _release_handlers(logger: logging.Logger, handlers: List[logging.Handler]):
+    """Detaches and closes the log handlers of a finished run"""
+    for handler in handlers:
+        logger.removeHandler(handler)
+        handler.close()
 
 
 def download(
@@ -230,6 +735,10 @@ def download(
     is_valid_file: Optional[Callable[[bytes], bool]] = None,
     proxy: Optional[str] = None,
     random_subsets: Optional[dict] = None,
+    basename_format: str = "sha1_hex",
+    tcp_connections_per_host: int = 0,
+    read_bufsize: int = 2**20,
+    only_modified: bool = False,
 ):
     """Core download function that takes an interable (sync or async)
 
@@ -239,14 +748,15 @@ def download(
             The text file should have one url per line and optional data after a whitespace.
         root (str, optional): Root path of downloads. Defaults to "data".
         tcp_connections (int, optional): Maximum number of concurrent TCP connections. Defaults to 128.
-        nb_workers (int, optional): Maximum number of workers. Defaults to 128.
-        batch_size (int, optional): Maximum queue batch size. Defaults to 8.
+        nb_workers (int, optional): Maximum number of concurrent downloads. Defaults to 128.
+        batch_size (int, optional): Unused, items are scheduled one by one.
+            Kept for backwards compatibility.
         retries (int, optional): Maximum number of attempts. Defaults to 1, which means one try.
         loglevel (str, optional): Set logger logging level.
             This shows failed downloads and a progressbar. Setting it to `ERROR` disables the progressbar.
             Setting it to `CRITICAL` disables all logging. Defaults to `INFO`.
         error_log_path (Path, optional): Writes errors to file. Defaults to None.
-        overwrite (bool): overwrite files with existing `baseline` signature, Defaults to False.
+        overwrite (bool): overwrite files with existing `baseline` signature. Defaults to False.
         is_valid_file (optional): A function that takes bytes
             and checks if the bytes originate from a valid file
             (used to check of corrupt files). Defaults to None.
@@ -258,6 +768,19 @@ def download(
             e.g. `{'train': 0.9, test': 0.1}` will result in 90% of the items
             go into a `train` subfolder and 10% into a `test` subfolder.
             The propabilities have to sum up to `1.0` to avoid an error.
+        basename_format (str): How basenames are derived from urls of items that
+            do not provide one, see `gbif_dl.utils.basename_hasher`. Defaults to `sha1_hex`,
+            the file names of previous versions. `blake2b_b32` gives shorter names,
+            but existing files named with `sha1_hex` are then not recognized.
+        tcp_connections_per_host (int, optional): Maximum number of concurrent TCP connections
+            to the same host, to stay within the limits of individual media servers.
+            Defaults to 0, which only applies `tcp_connections`.
+        read_bufsize (int, optional): Size of the response read buffer in bytes. Larger buffers
+            need fewer reads for big media files. Defaults to 1 MiB.
+        only_modified (bool, optional): Together with `overwrite`, existing files are requested
+            with `If-Modified-Since` and only replaced if the server reports a newer version.
+            Files keep the `Last-Modified` time of the server for this comparison.
+            Defaults to False, which downloads existing files again.
 
     Returns:
         dict: A dict of download statistics.
@@ -266,63 +789,100 @@ def download(
         NotImplementedError: If generator turns out to be invalid.
     """
 
-    if isinstance(items, (Path, str)):
-        if Path(items).exists():
-            # ignore all string after first space
-            items = [l.split(" ")[0] for l in Path(items).read_text().splitlines()]
-
-    # check if the generator is async
-    if not inspect.isasyncgen(items):
-        # if its not, apply hack to make it async
-        if inspect.isgenerator(items) or isinstance(items, Iterable):
-            items = aiostream.stream.iterate(items)
-        else:
-            raise NotImplementedError("Provided iteratable could not be converted")
-
-    if random_subsets is not None:
-        p = random_subsets.values()
-        if sum(p) != 1.0:
-            raise RuntimeError("Make sure that weight probabilities add up to one")
-
-    logger = logging.getLogger("error_urls")
-
-    # set log format suitable for error logs and io
-    formatter = logging.Formatter("%(message)s %(status)s")
-    # set default log level to only receive errors
-    logger.setLevel(loglevel)
+    items, params, logger, handlers = _prepare_download(
+        items,
+        root,
+        loglevel,
+        error_log_path,
+        overwrite,
+        is_valid_file,
+        proxy,
+        random_subsets,
+        basename_format,
+        only_modified,
+    )
 
-    handlers = []
-    if logger.getEffectiveLevel() <= logging.ERROR:
-        # write errors to std.out
-        sh = logging.StreamHandler(sys.stdout)
-        sh.setFormatter(formatter)
-        handlers.append(sh)
-        # in case an error path is set, also write errors to file
-        if isinstance(error_log_path, str):
-            fh = logging.FileHandler(error_log_path)
-            fh.setFormatter(formatter)
-            handlers.append(fh)
+    try:
+        return run_async(
+            _download_from_asyncgen,
+            items,
+            tcp_connections=tcp_connections,
+            nb_workers=nb_workers,
+            batch_size=batch_size,
+            retries=retries,
+            read_bufsize=read_bufsize,
+            logger=logger,
+            params=params,
+            tcp_connections_per_host=tcp_connections_per_host,
+        )
+    finally:
+        _release_handlers(logger, handlers)
+
+
+async def download_async(
+    items: Union[Generator, AsyncGenerator, Iterable, Path],
+    root: str = "data",
+    tcp_connections: int = 128,
+    nb_workers: int = 128,
+    batch_size: int = 16,
+    retries: int = 1,
+    loglevel: str = "INFO",
+    error_log_path: Path = None,
+    overwrite: bool = False,
+    is_valid_file: Optional[Callable[[bytes], bool]] = None,
+    proxy: Optional[str] = None,
+    random_subsets: Optional[dict] = None,
+    basename_format: str = "sha1_hex",
+    session: Optional[aiohttp.ClientSession] = None,
+    tcp_connections_per_host: int = 0,
+    read_bufsize: int = 2**20,
+    only_modified: bool = False,
+):
+    """Awaitable variant of `download` for code that already runs an event loop
 
-    for handler in handlers:
-        logger.addHandler(handler)
+    Passing the same `session` to several calls reuses its connection pool,
+    so DNS lookups and TLS handshakes are not repeated for every call.
 
-    logger.propagate = False
+    Args:
+        items, root, tcp_connections, nb_workers, batch_size, retries, loglevel,
+        error_log_path, overwrite, is_valid_file, proxy, random_subsets, basename_format,
+        tcp_connections_per_host, read_bufsize, only_modified: See `download`.
+        session (aiohttp.ClientSession, optional): Session used for the downloads. It is not
+            closed afterwards, `tcp_connections`, `tcp_connections_per_host` and `read_bufsize`
+            only apply when no session is given. Defaults to None, which creates a session
+            for this call.
 
-    params = {
-        "root": root,
-        "overwrite": overwrite,
-        "is_valid_file": is_valid_file,
-        "proxy": proxy,
-        "random_subsets": random_subsets,
-    }
+    Returns:
+        dict: A dict of download statistics.
 
-    return run_async(
-        _download_from_asyncgen,
+    Raises:
+        NotImplementedError: If generator turns out to be invalid.
+    """
+    items, params, logger, handlers = _prepare_download(
         items,
-        tcp_connections=tcp_connections,
-        nb_workers=nb_workers,
-        batch_size=batch_size,
-        retries=retries,
-        logger=logger,
-        params=params,
+        root,
+        loglevel,
+        error_log_path,
+        overwrite,
+        is_valid_file,
+        proxy,
+        random_subsets,
+        basename_format,
+        only_modified,
     )
+
+    try:
+        return await _download_from_asyncgen(
+            items,
+            tcp_connections=tcp_connections,
+            nb_workers=nb_workers,
+            batch_size=batch_size,
+            retries=retries,
+            read_bufsize=read_bufsize,
+            logger=logger,
+            params=params,
+            session=session,
+            tcp_connections_per_host=tcp_connections_per_host,
+        )
+    finally:
+        _release_handlers(logger, handlers)
@@ -2,11 +2,20 @@
 Utility functions
 """
 import asyncio
+import base64
 import functools
+import hashlib
 import threading
+from typing import Callable
 from tqdm import tqdm
 from . import runners
 
+try:
+    # libuv based event loop with less overhead per socket event
+    from uvloop import new_event_loop as _loop_factory
+except ImportError:
+    _loop_factory = None
+
 
 def watchdog(afunc):
     """Stops all tasks if there is an error"""
@@ -42,13 +51,14 @@ class RunThread(threading.Thread):
         super().__init__()
 
     def run(self):
-        self.result = runners.run(self.func(*self.args, **self.kwargs))
+        self.result = runners.run(self.func(*self.args, **self.kwargs), loop_factory=_loop_factory)
 
 
 def run_async(func, *args, **kwargs):
     """async wrapper to detect if asyncio loop is already running
 
     This is useful when already running in async thread.
+    The coroutine runs on a uvloop event loop when uvloop is installed.
     """
     try:
         loop = get_or_create_eventloop()
@@ -60,4 +70,41 @@ def run_async(func, *args, **kwargs):
         thread.join()
         return thread.result
     else:
-        return runners.run(func(*args, **kwargs))
+        return runners.run(func(*args, **kwargs), loop_factory=_loop_factory)
+
+
+def _blake2b_b32(url: str) -> str:
+    digest = hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+    return base64.b32encode(digest).decode("ascii").rstrip("=")
+
+
+def _sha1_hex(url: str) -> str:
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+# supported ways to derive file basenames from urls
+BASENAME_FORMATS = {
+    "sha1_hex": _sha1_hex,
+    "blake2b_b32": _blake2b_b32,
+}
+
+
+def basename_hasher(basename_format: str = "sha1_hex") -> Callable[[str], str]:
+    """Returns the function that derives a file basename from an url
+
+    Args:
+        basename_format (str, optional): One of `BASENAME_FORMATS`.
+            `sha1_hex` is the hex encoded SHA-1 digest (40 chars) used by all previous versions.
+            `blake2b_b32` is a base32 encoded 128 bit BLAKE2b digest (26 chars) that is
+            faster to compute, but names differ from those of existing downloads.
+            Defaults to `sha1_hex`.
+
+    Raises:
+        ValueError: If the basename format is not supported.
+    """
+    try:
+        return BASENAME_FORMATS[basename_format]
+    except KeyError:
+        raise ValueError(
+            f"Unknown basename format {basename_format}, use one of {list(BASENAME_FORMATS)}"
+        )
@@ -17,10 +17,8 @@ setup(
     license="MIT",
     python_requires=">=3.6",
     install_requires=[
-        "aiofiles>=0.6.0",
         "aiohttp>=3.7.2",
-        "aiohttp-retry>=2.3",
-        "aiostream>=0.4.3",
+        "aiohttp-retry>=2.5",
         "pygbif>=0.5.0",
         "requests-cache==0.7.4",
         "pescador>=2.1.0",
@@ -29,7 +27,11 @@ setup(
         "tqdm",
         "typing-extensions; python_version < '3.8'",
     ],
-    extras_require={"tests": ["pytest"], "docs": ["pdoc3"]},
+    extras_require={
+        "tests": ["pytest"],
+        "docs": ["pdoc3"],
+        "fast": ["orjson", "aiodns", 'uvloop; platform_system != "Windows"'],
+    },
     # entry_points={"console_scripts": ["gbif_dl=gbif_dl.cli:download"]},
     packages=find_packages(),
     include_package_data=True,
@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import gbif_dl
 
@@ -48,3 +49,97 @@ def test_nb_samples_substreams(queries, key="speciesKey"):
 def test_gbif_query_count(queries):
     count = gbif_dl.api.gbif_count(**queries)
     assert count > 0
+
+
+def test_subset_streams_resolution():
+    subset_index = gbif_dl.api._index_subset_streams(
+        {"train": {"speciesKey": [5352251, 3190653]}, "test": {"speciesKey": "*"}}
+    )
+    assert gbif_dl.api._resolve_subset({"speciesKey": 3190653}, *subset_index) == "train"
+    assert gbif_dl.api._resolve_subset({"speciesKey": 3189866}, *subset_index) == "test"
+    assert gbif_dl.api._resolve_subset({"datasetKey": "xyz"}, *subset_index) is None
+    subset_index = gbif_dl.api._index_subset_streams({"train": {"speciesKey": {5352251}}})
+    assert gbif_dl.api._resolve_subset({"speciesKey": 5352251}, *subset_index) == "train"
+
+
+def test_count_key():
+    key = gbif_dl.api._count_key("StillImage", {"speciesKey": [2, 1], "country": "FR"})
+    assert key == ("StillImage", ("country", "FR"), ("speciesKey", (1, 2)))
+    # order of keys and of collection values does not matter
+    assert key == gbif_dl.api._count_key("StillImage", {"country": "FR", "speciesKey": (1, 2)})
+    assert key == gbif_dl.api._count_key("StillImage", {"speciesKey": {1, 2}, "country": "FR"})
+    assert key != gbif_dl.api._count_key("MovingImage", {"speciesKey": [1, 2], "country": "FR"})
+    # nested and unhashable values are frozen
+    hash(gbif_dl.api._count_key("StillImage", {"geometry": {"a": [1, {2}]}}))
+
+
+def test_query_generator_async(monkeypatch):
+    records = [
+        {"speciesKey": i, "media": [{"identifier": f"u{i}a"}, {"identifier": f"u{i}b"}]}
+        for i in range(5)
+    ]
+    # records without media or label are skipped
+    records += [{"speciesKey": 9}, {"media": [{"identifier": "nolabel"}]}]
+    offsets = []
+
+    async def fetch_page(session, params, offset, limit):
+        offsets.append(offset)
+        return {
+            "offset": offset,
+            "results": records[offset : offset + limit],
+            "endOfRecords": offset + limit >= len(records),
+        }
+
+    monkeypatch.setattr(gbif_dl.api, "_fetch_page", fetch_page)
+
+    async def collect(**kwargs):
+        generator = gbif_dl.api.gbif_query_generator_async(
+            page_limit=2, label="speciesKey", speciesKey=[1, 2], **kwargs
+        )
+        return [item async for item in generator]
+
+    items = asyncio.run(collect())
+    assert offsets == [0, 2, 4, 6]
+    assert [item["label"] for item in items] == ["0", "1", "2", "3", "4"]
+    assert all(item["url"][1] == item["label"] for item in items)
+
+    items = asyncio.run(collect(one_media_per_occurrence=False))
+    assert [item["url"] for item in items] == [f"u{i}{m}" for i in range(5) for m in "ab"]
+
+
+def test_query_generator_positional_args(monkeypatch):
+    calls = []
+
+    def search(*args, **kwargs):
+        calls.append(args)
+        return {
+            "offset": kwargs["offset"],
+            "results": [{"speciesKey": 1, "media": [{"identifier": "u1"}]}],
+            "endOfRecords": True,
+        }
+
+    def search_concurrent(*args, **kwargs):
+        raise AssertionError("positional arguments are only passed on by pygbif")
+
+    monkeypatch.setattr(gbif_dl.api.pygbif.occurrences, "search", search)
+    monkeypatch.setattr(gbif_dl.api, "_search_pages_concurrent", search_concurrent)
+
+    # page_concurrency falls back to the sequential pages, which keep the positional arguments
+    generator = gbif_dl.api.gbif_query_generator(
+        300, "StillImage", True, True, "speciesKey", None, 3189866, page_concurrency=4
+    )
+    assert [item["url"] for item in generator] == ["u1"]
+    assert calls == [(3189866,)]
+
+
+def test_weighted_streams_without_occurrences(monkeypatch, queries):
+    monkeypatch.setattr(gbif_dl.api, "gbif_counts", lambda queries, **kwargs: [0] * len(queries))
+
+    data_generator = gbif_dl.api.generate_urls(
+        queries=queries,
+        label="speciesKey",
+        nb_samples=10,
+        split_streams_by=["speciesKey"],
+        weighted_streams=True,
+    )
+    assert list(data_generator) == []
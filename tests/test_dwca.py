@@ -28,3 +28,38 @@ def test_url_generator(doi):
     )
     item = next(data_generator)
     assert item["url"]
+
+
+def test_dwca_generator_skips_missing_labels(monkeypatch):
+    from collections import namedtuple
+
+    dwca = gbif_dl.dwca
+    Extension = namedtuple("Extension", "rowtype data")
+    Row = namedtuple("Row", "extensions data")
+
+    def row(url, **data):
+        media = {dwca._MM_TYPE_KEY: "StillImage", dwca._MM_IDENT_KEY: url}
+        return Row([Extension(dwca._MM_ROWTYPE, media)], data)
+
+    label_key = dwca.gbifqualname + "speciesKey"
+    rows = [
+        row("a", **{label_key: "1"}),
+        row("b"),
+        row("c", **{label_key: ""}),
+        row("d", **{label_key: None}),
+    ]
+
+    class Reader:
+        def __init__(self, path):
+            pass
+
+        def __enter__(self):
+            return iter(rows)
+
+        def __exit__(self, *exc):
+            pass
+
+    monkeypatch.setattr(dwca, "DwCAReader", Reader)
+    items = list(dwca.dwca_generator("archive.zip"))
+    assert [(item["url"], item["label"]) for item in items] == [("a", "1")]
+    assert len(list(dwca.dwca_generator("archive.zip", label=None))) == 4
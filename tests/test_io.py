@@ -1,23 +1,85 @@
 import pytest
 import gbif_dl
 import asyncio
+import json
+import logging
+import aiohttp
+import os
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from types import MappingProxyType
+from aiohttp import web
 
+# all media served by the local server were last modified at this time
+LAST_MODIFIED = datetime(2021, 3, 1, 12, 0, tzinfo=timezone.utc)
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(1024)
+# larger than the write buffer of the downloader, written in several parts
+LARGE_PNG = PNG + bytes(3 * 1024 * 1024)
 
-@pytest.fixture
+
+@pytest.fixture(scope="module")
+def media_server():
+    """Local media server running in a background thread
+
+    It serves the same png for every path, honours `If-Modified-Since` and
+    records the status of each response in `statuses`. The path `slow` stalls
+    for ten seconds before responding, the path `large` serves `LARGE_PNG`.
+    """
+    statuses = []
+
+    async def media(request):
+        if request.match_info["name"] == "slow":
+            await asyncio.sleep(10)
+        since = request.if_modified_since
+        if since is not None and since >= LAST_MODIFIED:
+            statuses.append(304)
+            return web.Response(status=304)
+        statuses.append(200)
+        return web.Response(
+            body=LARGE_PNG if request.match_info["name"] == "large" else PNG,
+            content_type="image/png",
+            headers={"Last-Modified": format_datetime(LAST_MODIFIED, usegmt=True)},
+        )
+
+    app = web.Application()
+    app.router.add_get("/{name}", media)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    host, port = runner.addresses[0][:2]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield "http://%s:%d/" % (host, port), statuses
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+@pytest.fixture(params=[dict, MappingProxyType])
 def urls(request):
+    # plain dicts and read-only views, the downloader must not mutate items
     return [
-        {
-            "url": "https://bs.plantnet.org/image/o/6d5ed1f1769b4818ed5a234670dba742bf5b28a5",
-            "basename": "e75239cd029162c81f16a6d6afb1057d2437bcc8",
-            "label": "3189866",
-            "subset": "train",
-        },
-        {
-            "url": "https://bs.plantnet.org/image/o/f32365ec997bdf06b57adcfca6a49c6d9602b321",
-            "basename": "e04a36f124b875a16b5393a8fdef36846ada8e35",
-            "label": "3189866",
-            "subset": "test",
-        },
+        request.param(item)
+        for item in (
+            {
+                "url": "https://bs.plantnet.org/image/o/6d5ed1f1769b4818ed5a234670dba742bf5b28a5",
+                "basename": "e75239cd029162c81f16a6d6afb1057d2437bcc8",
+                "label": "3189866",
+                "subset": "train",
+            },
+            {
+                "url": "https://bs.plantnet.org/image/o/f32365ec997bdf06b57adcfca6a49c6d9602b321",
+                "basename": "e04a36f124b875a16b5393a8fdef36846ada8e35",
+                "label": "3189866",
+                "subset": "test",
+            },
+        )
     ]
 
 
@@ -53,3 +115,224 @@ def test_download_fromasybc(urls):
 def test_download_error(bad_urls):
     stats = gbif_dl.stores.dl_async.download(bad_urls)
     assert stats["failed"] == 1
+
+
+def test_download_shared_session(media_server, tmp_path):
+    base_url, _ = media_server
+    items = [{"url": base_url + name, "basename": name, "label": "0"} for name in "abc"]
+    kwargs = dict(root=str(tmp_path), loglevel="CRITICAL")
+
+    async def main():
+        # both calls reuse the connections of a single session
+        async with aiohttp.ClientSession() as session:
+            first = await gbif_dl.stores.dl_async.download_async(items, session=session, **kwargs)
+            second = await gbif_dl.stores.dl_async.download_async(items, session=session, **kwargs)
+            assert not session.closed
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first["success"] == len(items)
+    assert second["skipped"] == len(items)
+
+
+@pytest.mark.parametrize(
+    "header, extension",
+    [
+        (b"\xff\xd8\xff\xe0" + bytes(16), "jpg"),
+        (b"\x89PNG\r\n\x1a\n" + bytes(16), "png"),
+        (b"GIF87a" + bytes(16), "gif"),
+        (b"GIF89a" + bytes(16), "gif"),
+        (b"RIFF\x00\x00\x00\x00WEBPVP8 " + bytes(16), "webp"),
+        # RIFF containers other than WebP are left to filetype
+        (b"RIFF\x00\x00\x00\x00WAVEfmt " + bytes(16), "wav"),
+        (b"<html><body>not found</body></html>", None),
+        (b"", None),
+    ],
+)
+def test_guess_extension(header, extension):
+    assert gbif_dl.stores.dl_async._guess_extension(header) == extension
+
+
+@pytest.mark.parametrize(
+    "content_type, extension",
+    [
+        ("image/png", "png"),
+        ("IMAGE/PNG; charset=binary", "png"),
+        ("video/mp4", "mp4"),
+        ("audio/mpeg", "mp3"),
+        # non media types are never stored
+        ("text/html; charset=utf-8", None),
+        ("application/octet-stream", None),
+        # unknown media types and missing headers
+        ("image/x-unknown-format", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_extension_from_content_type(content_type, extension):
+    assert gbif_dl.stores.dl_async._extension_from_content_type(content_type) == extension
+
+
+def test_download_error_logged_once_per_run(tmp_path):
+    # nothing listens on the discard port, the connection is refused
+    url = "http://127.0.0.1:9/missing"
+    error_log_path = str(tmp_path / "errors.log")
+    logger = logging.getLogger("error_urls")
+    # the test runner may attach its own capture handlers to the logger
+    handlers = list(logger.handlers)
+    for _ in range(3):
+        stats = gbif_dl.stores.dl_async.download(
+            [url], root=str(tmp_path), loglevel="ERROR", error_log_path=error_log_path
+        )
+        assert stats["failed"] == 1
+    with open(error_log_path) as f:
+        assert f.read().count(url) == 3
+    assert logger.handlers == handlers
+
+
+def test_download_overwrite_only_modified(media_server, tmp_path):
+    base_url, statuses = media_server
+    items = [{"url": base_url + "a", "basename": "a", "label": "0"}]
+    path = tmp_path / "0" / "a.png"
+    kwargs = dict(root=str(tmp_path), loglevel="CRITICAL")
+
+    stats = gbif_dl.stores.dl_async.download(items, **kwargs)
+    assert stats["success"] == 1
+    # files carry the modification time of the server
+    assert os.stat(path).st_mtime == LAST_MODIFIED.timestamp()
+
+    # existing files are skipped without a request
+    del statuses[:]
+    stats = gbif_dl.stores.dl_async.download(items, **kwargs)
+    assert stats["skipped"] == 1
+    assert statuses == []
+
+    # overwrite always downloads the file again
+    path.write_bytes(b"corrupt")
+    stats = gbif_dl.stores.dl_async.download(items, overwrite=True, **kwargs)
+    assert stats["success"] == 1
+    assert statuses == [200]
+    assert path.read_bytes() == PNG
+
+    # only_modified lets the server answer unchanged files with 304
+    stats = gbif_dl.stores.dl_async.download(items, overwrite=True, only_modified=True, **kwargs)
+    assert stats["skipped"] == 1
+    assert statuses == [200, 304]
+    assert path.read_bytes() == PNG
+
+
+def test_download_generator_error_cancels_pending(media_server, tmp_path, caplog):
+    base_url, _ = media_server
+
+    async def items():
+        yield base_url + "slow"
+        raise RuntimeError("generator failed")
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await gbif_dl.stores.dl_async.download_async(
+                items(), root=str(tmp_path), loglevel="CRITICAL"
+            )
+        # the stalled download was cancelled and not left running
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    with caplog.at_level(logging.ERROR, logger="asyncio"):
+        asyncio.run(main())
+    assert "Exception in callback" not in caplog.text
+
+
+@pytest.mark.parametrize("name", ["a", "large"])
+@pytest.mark.parametrize("nb_items", [4, 50])
+def test_download_duplicate_items(media_server, tmp_path, name, nb_items):
+    base_url, _ = media_server
+    # duplicates are scheduled while the first download is still running
+    items = [{"url": base_url + name, "basename": name}] * nb_items
+
+    stats = gbif_dl.stores.dl_async.download(items, root=str(tmp_path), loglevel="CRITICAL")
+    assert stats == {"failed": 0, "skipped": nb_items - 1, "success": 1}
+    assert os.listdir(tmp_path) == [name + ".png"]
+
+
+async def _collect(agen, limit=None):
+    items = []
+    async for item in agen:
+        items.append(item)
+        if limit is not None and len(items) == limit:
+            break
+    return items
+
+
+def test_iterate_threaded_order():
+    # many small chunks through a short queue keep the producer waiting for free slots
+    agen = gbif_dl.stores.dl_async._iterate_threaded(iter(range(1000)), chunk_size=7, max_chunks=2)
+    assert asyncio.run(_collect(agen)) == list(range(1000))
+
+
+def test_iterate_threaded_error():
+    def items():
+        yield 1
+        yield 2
+        raise ValueError("page request failed")
+
+    async def main():
+        received = []
+        with pytest.raises(ValueError, match="page request failed"):
+            async for item in gbif_dl.stores.dl_async._iterate_threaded(items()):
+                received.append(item)
+        return received
+
+    # items produced before the error are still handed over
+    assert asyncio.run(main()) == [1, 2]
+
+
+def test_iterate_threaded_close():
+    producers = []
+
+    def items():
+        producers.append(threading.current_thread())
+        i = 0
+        while True:
+            yield i
+            i += 1
+
+    async def main():
+        agen = gbif_dl.stores.dl_async._iterate_threaded(items(), chunk_size=4, max_chunks=2)
+        assert await _collect(agen, limit=10) == list(range(10))
+        await agen.aclose()
+        # the loop keeps running while the producer thread winds down
+        for _ in range(100):
+            if not producers[0].is_alive():
+                break
+            await asyncio.sleep(0.01)
+        assert not producers[0].is_alive()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("item_type", [dict, MappingProxyType])
+def test_download_mapping_items(media_server, tmp_path, item_type):
+    base_url, _ = media_server
+    label = item_type({"speciesKey": 3189866})
+    items = [item_type({"url": base_url + "a", "basename": "a", "label": label})]
+
+    stats = gbif_dl.stores.dl_async.download(items, root=str(tmp_path), loglevel="CRITICAL")
+    assert stats["success"] == 1
+    # mapping labels are stored in a json sidecar
+    assert (tmp_path / "a.png").read_bytes() == PNG
+    assert json.loads((tmp_path / "a.json").read_text()) == {"speciesKey": 3189866}
+
+
+@pytest.mark.parametrize("name, body", [("a", PNG), ("large", LARGE_PNG)])
+def test_download_concurrent_overwrite(media_server, tmp_path, name, body):
+    base_url, _ = media_server
+    # duplicates of the same file are downloaded at the same time
+    items = [{"url": base_url + name, "basename": name}] * 8
+
+    stats = gbif_dl.stores.dl_async.download(
+        items, root=str(tmp_path), overwrite=True, loglevel="CRITICAL"
+    )
+    assert stats["failed"] == 0
+    assert stats["success"] == len(items)
+    assert (tmp_path / (name + ".png")).read_bytes() == body
+    # no temporary files are left behind
+    assert os.listdir(tmp_path) == [name + ".png"]
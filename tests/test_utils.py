@@ -0,0 +1,23 @@
+import pytest
+import gbif_dl
+
+URL = "https://bs.plantnet.org/image/o/6d5ed1f1769b4818ed5a234670dba742bf5b28a5"
+
+
+def test_basename_default_is_sha1_hex():
+    assert gbif_dl.utils.basename_hasher() is gbif_dl.utils.basename_hasher("sha1_hex")
+
+
+def test_basename_sha1_hex():
+    hash_url = gbif_dl.utils.basename_hasher("sha1_hex")
+    assert hash_url(URL) == "e75239cd029162c81f16a6d6afb1057d2437bcc8"
+
+
+def test_basename_blake2b_b32():
+    hash_url = gbif_dl.utils.basename_hasher("blake2b_b32")
+    assert hash_url(URL) == "5MN5OLNPIB5G57R4IY6UL3MOVM"
+
+
+def test_basename_unknown_format():
+    with pytest.raises(ValueError):
+        gbif_dl.utils.basename_hasher("md5")